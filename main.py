@@ -14,14 +14,19 @@ Features:
 
 import os
 import pathlib
+import re
 import shutil
+import time
 import sqlite3
-import json
 from typing import List, Optional
-from fastapi import FastAPI, UploadFile, File, Form, Request, HTTPException, Query
-from fastapi.responses import JSONResponse, StreamingResponse, FileResponse
-from fastapi.middleware.cors import CORSMiddleware
+from fastapi import FastAPI, UploadFile, File, Form, Request, HTTPException, Query, Response
+from fastapi.responses import JSONResponse, FileResponse, ORJSONResponse
+from sse_starlette.sse import EventSourceResponse
 import asyncio
+import aiofiles  # ensure installed
+import orjson  # ensure installed
+import aiosqlite  # ensure installed
+from aiosqlitepool import SQLiteConnectionPool
 import ollama  # ensure installed & configured
 import uvicorn
 
@@ -30,32 +35,161 @@ UPLOAD_DIR = BASE / "uploads"
 DB_PATH = BASE / "palms_prod.db"
 MAX_FILE_SIZE = 20 * 1024 * 1024  # 20 MB
 ALLOWED_EXT = {"pdf","csv","xlsx","xls","txt"}
+# When serving behind Nginx, set e.g. X_ACCEL_REDIRECT_PREFIX=/protected and add an
+# "internal" location mapping that prefix to UPLOAD_DIR; downloads are then sent
+# by Nginx directly instead of copying file bytes through Python.
+X_ACCEL_REDIRECT_PREFIX = os.environ.get("X_ACCEL_REDIRECT_PREFIX", "")
 
 UPLOAD_DIR.mkdir(parents=True, exist_ok=True)
 
-app = FastAPI(title="PALMS WMS AI Assistant API")
-
-# In production restrict to actual domains
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["*"],
-    allow_credentials=True,
-    allow_methods=["*"],
-    allow_headers=["*"],
-)
+# orjson serializes dict-of-rows payloads (/history, /files) ~5x faster than stdlib json
+app = FastAPI(title="PALMS WMS AI Assistant API", default_response_class=ORJSONResponse)
+
+# CORS here is wildcard, so the headers are constants: a minimal ASGI shim
+# appends them without CORSMiddleware's per-request origin/config checks.
+# In production restrict to actual domains.
+_CORS_HEADERS = [
+    (b"access-control-allow-origin", b"*"),
+    (b"access-control-allow-methods", b"*"),
+    (b"access-control-allow-headers", b"*"),
+]
+
+class WildcardCORSMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        if scope["method"] == "OPTIONS":
+            # answer preflight directly with the constant headers
+            await send({"type": "http.response.start", "status": 204,
+                        "headers": _CORS_HEADERS + [(b"access-control-max-age", b"600")]})
+            await send({"type": "http.response.body", "body": b""})
+            return
+
+        async def send_with_cors(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers") or []) + _CORS_HEADERS
+            await send(message)
+
+        await self.app(scope, receive, send_with_cors)
+
+app.add_middleware(WildcardCORSMiddleware)
 
 DEFAULT_MODEL = "phi3:mini"
-CHUNK_DELAY = 0.01  # small delay to yield between SSE events
+
+# async client so token iteration awaits the HTTP stream instead of blocking the loop
+OLLAMA = ollama.AsyncClient()
 
 # ---------------- DB helpers ----------------
+# single source for each SQL string: reusing identical text keeps the
+# connection's prepared-statement cache hit rate at ~100%
+SQL_INSERT_FILE = "INSERT INTO files (session_id, filename, filepath, size) VALUES (?,?,?,?)"
+SQL_LIST_FILES = "SELECT filename, filepath, size, uploaded_at FROM files WHERE session_id=? ORDER BY uploaded_at DESC"
+SQL_FILE_PATHS = "SELECT filepath FROM files WHERE session_id=?"
+SQL_FILE_PATH = "SELECT filepath FROM files WHERE session_id=? AND filename=?"
+SQL_DELETE_FILES = "DELETE FROM files WHERE session_id=?"
+SQL_INSERT_MESSAGE = "INSERT INTO messages (session_id, role, content) VALUES (?,?,?)"
+SQL_GET_HISTORY = "SELECT role, content, created_at FROM messages WHERE session_id=? ORDER BY created_at ASC"
+SQL_CLEAR_HISTORY = "DELETE FROM messages WHERE session_id=?"
+
 def get_db_conn():
-    con = sqlite3.connect(str(DB_PATH), check_same_thread=False)
+    con = sqlite3.connect(str(DB_PATH), check_same_thread=False, cached_statements=256)
+    con.row_factory = sqlite3.Row
+    # journal_mode=WAL is persistent (set once in init_db); the rest are per-connection
+    con.execute("PRAGMA busy_timeout=5000")
+    con.execute("PRAGMA foreign_keys=ON")
+    return con
+
+async def _pool_conn():
+    # factory for the pool: every pooled connection inherits the per-connection pragmas
+    con = await aiosqlite.connect(str(DB_PATH), cached_statements=256)
     con.row_factory = sqlite3.Row
+    await con.execute("PRAGMA busy_timeout=5000")
+    await con.execute("PRAGMA foreign_keys=ON")
     return con
 
+# long-lived pooled connections keep SQLite's page cache hot and avoid
+# connect/teardown syscalls on every request
+POOL = SQLiteConnectionPool(_pool_conn)
+
+# single-writer pattern: even under WAL, concurrent writers race on the write
+# lock. All mutations funnel through this queue into one dedicated connection,
+# which batches up to 64 queued writes per transaction; readers keep using the
+# pool concurrently.
+WRITE_Q: asyncio.Queue = asyncio.Queue()
+_WRITE_BATCH = 64
+_WRITE_WINDOW = 0.01  # seconds to linger for more writes to share a commit
+
+# set by init_db() when SQLite is built from the begin-concurrent-pnu-wal2
+# branch (compiled with -DSQLITE_ENABLE_SETLK_TIMEOUT=1); stock builds get
+# plain WAL and deferred transactions
+WAL2 = False
+
+async def _write_worker():
+    con = await _pool_conn()
+    # BEGIN CONCURRENT blocks writers at page level instead of file level, so
+    # transactions for disjoint sessions can commit in parallel
+    begin = "BEGIN CONCURRENT" if WAL2 else "BEGIN"
+    try:
+        while True:
+            batch = [await WRITE_Q.get()]
+            await asyncio.sleep(_WRITE_WINDOW)
+            while len(batch) < _WRITE_BATCH:
+                try:
+                    batch.append(WRITE_Q.get_nowait())
+                except asyncio.QueueEmpty:
+                    break
+            try:
+                try:
+                    await con.execute(begin)
+                except sqlite3.OperationalError:
+                    # wal2 without BEGIN CONCURRENT support; drop to deferred for good
+                    begin = "BEGIN"
+                    await con.execute(begin)
+                for sql, params, many, _ in batch:
+                    if many:
+                        await con.executemany(sql, params)
+                    else:
+                        await con.execute(sql, params)
+                await con.commit()
+                for *_, fut in batch:
+                    if not fut.done(): fut.set_result(None)
+            except Exception as e:
+                try: await con.rollback()
+                except Exception: pass
+                for *_, fut in batch:
+                    if not fut.done(): fut.set_exception(e)
+    finally:
+        # aiosqlite connections own a non-daemon thread; close on cancellation
+        # so interpreter exit doesn't hang
+        await con.close()
+
+async def _db_write(sql: str, params, many: bool = False):
+    # enqueue a mutation and wait for the writer's commit ack
+    fut = asyncio.get_running_loop().create_future()
+    await WRITE_Q.put((sql, params, many, fut))
+    await fut
+
 def init_db():
+    global WAL2
     con = get_db_conn()
     cur = con.cursor()
+    # WAL lets readers proceed while a write is in flight; tuned pragmas keep
+    # the hot page cache in memory and bound checkpoint/lock stalls.
+    # Prefer wal2 (removes the WAL-apply stall); unrecognized values leave the
+    # previous journal mode, so retry with plain WAL on stock builds.
+    mode = cur.execute("PRAGMA journal_mode=wal2").fetchone()[0]
+    WAL2 = mode == "wal2"
+    if not WAL2:
+        cur.execute("PRAGMA journal_mode=WAL")
+    cur.execute("PRAGMA synchronous=NORMAL")
+    cur.execute("PRAGMA temp_store=MEMORY")
+    cur.execute("PRAGMA cache_size=-64000")
+    cur.execute("PRAGMA mmap_size=268435456")
+    cur.execute("PRAGMA busy_timeout=5000")
+    cur.execute("PRAGMA wal_autocheckpoint=1000")
     cur.execute("""
       CREATE TABLE IF NOT EXISTS messages (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -75,22 +209,45 @@ def init_db():
         uploaded_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
       )
     """)
+    # session-scoped queries were full table scans without these
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_messages_sess_ts ON messages(session_id, created_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_files_sess ON files(session_id, uploaded_at DESC)")
+    cur.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_files_sess_name ON files(session_id, filename)")
+    cur.execute("ANALYZE")
     con.commit()
     con.close()
 
 init_db()
 
 # ---------------- utilities ----------------
+_SAFE_NAME_RE = re.compile(r"[^A-Za-z0-9._\- ]")
+
 def safe_filename(filename: str) -> str:
-    name = os.path.basename(filename)
-    allowed = "".join(c for c in name if c.isalnum() or c in "._- ")
-    return allowed[:255]
+    # C-level regex sub instead of a per-character Python loop
+    return _SAFE_NAME_RE.sub("", os.path.basename(filename))[:255]
 
 def allowed_file(filename: str) -> bool:
-    ext = filename.rsplit(".",1)[-1].lower() if "." in filename else ""
-    return ext in ALLOWED_EXT
+    # rpartition returns the whole name as ext when there is no dot; require the separator
+    _, sep, ext = filename.rpartition(".")
+    return bool(sep) and ext.lower() in ALLOWED_EXT
+
+def _sendfile_copy(src_fd: int, dest: pathlib.Path) -> int:
+    os.lseek(src_fd, 0, os.SEEK_SET)
+    dst_fd = os.open(dest, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    total = 0
+    try:
+        while True:
+            sent = os.sendfile(dst_fd, src_fd, None, 1 << 20)
+            if sent == 0:
+                break
+            total += sent
+            if total > MAX_FILE_SIZE:
+                break  # caller unlinks and raises
+    finally:
+        os.close(dst_fd)
+    return total
 
-def save_upload(session_id: str, upload: UploadFile) -> dict:
+async def save_upload(session_id: str, upload: UploadFile) -> dict:
     if not allowed_file(upload.filename):
         raise HTTPException(status_code=400, detail=f"File type not allowed: {upload.filename}")
     safe_name = safe_filename(upload.filename)
@@ -104,77 +261,105 @@ def save_upload(session_id: str, upload: UploadFile) -> dict:
         dest = session_dir / f"{base}_{counter}{ext}"
         counter += 1
     total = 0
-    with open(dest, "wb") as f:
-        while True:
-            chunk = upload.file.read(1024 * 32)
-            if not chunk:
-                break
-            total += len(chunk)
-            if total > MAX_FILE_SIZE:
-                f.close()
-                dest.unlink(missing_ok=True)
-                raise HTTPException(status_code=400, detail="File too large")
-            f.write(chunk)
-    return {"name": dest.name, "path": str(dest), "size": dest.stat().st_size}
-
-def record_file_db(session_id: str, meta: dict):
-    con = get_db_conn(); cur = con.cursor()
-    cur.execute("INSERT INTO files (session_id, filename, filepath, size) VALUES (?,?,?,?)", (session_id, meta['name'], meta['path'], meta['size']))
-    con.commit(); con.close()
-
-def list_files_db(session_id: str):
-    con = get_db_conn(); cur = con.cursor()
-    cur.execute("SELECT filename, filepath, size, uploaded_at FROM files WHERE session_id=? ORDER BY uploaded_at DESC", (session_id,))
-    rows = cur.fetchall(); con.close()
+    if getattr(upload.file, "_rolled", False):
+        # large uploads are spooled to disk by Starlette: copy kernel-to-kernel
+        # with sendfile instead of pulling every chunk into Python bytes
+        total = await asyncio.to_thread(_sendfile_copy, upload.file.fileno(), dest)
+        if total > MAX_FILE_SIZE:
+            dest.unlink(missing_ok=True)
+            raise HTTPException(status_code=400, detail="File too large")
+    else:
+        # 1 MiB async reads/writes: fewer syscalls and no event-loop stalls
+        async with aiofiles.open(dest, "wb") as f:
+            while chunk := await upload.read(1 << 20):
+                total += len(chunk)
+                if total > MAX_FILE_SIZE:
+                    await f.close()
+                    dest.unlink(missing_ok=True)
+                    raise HTTPException(status_code=400, detail="File too large")
+                await f.write(chunk)
+    # total was tracked while writing; no need for a stat() round-trip
+    return {"name": dest.name, "path": str(dest), "size": total}
+
+async def record_file_db(session_id: str, meta: dict):
+    await _db_write(SQL_INSERT_FILE, (session_id, meta['name'], meta['path'], meta['size']))
+
+async def list_files_db(session_id: str):
+    async with POOL.connection() as con:
+        cur = await con.execute(SQL_LIST_FILES, (session_id,))
+        rows = await cur.fetchall()
     return [{"name": r["filename"], "path": r["filepath"], "size": r["size"], "uploaded_at": r["uploaded_at"]} for r in rows]
 
-def delete_files_db(session_id: str, filenames: Optional[List[str]] = None):
-    con = get_db_conn(); cur = con.cursor()
+async def delete_files_db(session_id: str, filenames: Optional[List[str]] = None):
     if not filenames:
         # delete all for session
-        cur.execute("SELECT filepath FROM files WHERE session_id=?", (session_id,))
-        rows = cur.fetchall()
-        for r in rows:
-            try: os.remove(r["filepath"])
-            except: pass
-        cur.execute("DELETE FROM files WHERE session_id=?", (session_id,))
+        select_sql, delete_sql, params = SQL_FILE_PATHS, SQL_DELETE_FILES, (session_id,)
     else:
-        for fname in filenames:
-            cur.execute("SELECT filepath FROM files WHERE session_id=? AND filename=?", (session_id, fname))
-            r = cur.fetchone()
-            if r:
-                try: os.remove(r["filepath"])
-                except: pass
-                cur.execute("DELETE FROM files WHERE session_id=? AND filename=?", (session_id, fname))
-    con.commit(); con.close()
-
-def record_message_db(session_id: str, role: str, content: str):
-    con = get_db_conn(); cur = con.cursor()
-    cur.execute("INSERT INTO messages (session_id, role, content) VALUES (?,?,?)", (session_id, role, content))
-    con.commit(); con.close()
-
-def get_history_db(session_id: str):
-    con = get_db_conn(); cur = con.cursor()
-    cur.execute("SELECT role, content, created_at FROM messages WHERE session_id=? ORDER BY created_at ASC", (session_id,))
-    rows = cur.fetchall(); con.close()
+        marks = ",".join("?" * len(filenames))
+        select_sql = f"SELECT filepath FROM files WHERE session_id=? AND filename IN ({marks})"
+        delete_sql = f"DELETE FROM files WHERE session_id=? AND filename IN ({marks})"
+        params = (session_id, *filenames)
+    async with POOL.connection() as con:
+        cur = await con.execute(select_sql, params)
+        rows = await cur.fetchall()
+    await _db_write(delete_sql, params)
+
+    async def _unlink(path):
+        try: await asyncio.to_thread(os.remove, path)
+        except: pass
+    # unlink concurrently once the transaction has committed, off the event loop
+    await asyncio.gather(*(_unlink(r["filepath"]) for r in rows))
+
+async def record_message_db(session_id: str, role: str, content: str):
+    await _db_write(SQL_INSERT_MESSAGE, (session_id, role, content))
+
+async def record_messages_db(session_id: str, items: List[tuple]):
+    # batch of (role, content) pairs in one statement: one commit/fsync instead of N
+    await _db_write(SQL_INSERT_MESSAGE, [(session_id, r, c) for r, c in items], many=True)
+
+async def get_history_db(session_id: str):
+    async with POOL.connection() as con:
+        cur = await con.execute(SQL_GET_HISTORY, (session_id,))
+        rows = await cur.fetchall()
     return [{"role": r["role"], "content": r["content"], "created_at": r["created_at"]} for r in rows]
 
-def clear_history_db(session_id: str):
-    con = get_db_conn(); cur = con.cursor()
-    cur.execute("DELETE FROM messages WHERE session_id=?", (session_id,))
-    con.commit(); con.close()
+async def clear_history_db(session_id: str):
+    await _db_write(SQL_CLEAR_HISTORY, (session_id,))
 
 # ---------------- endpoints ----------------
 
+@app.on_event("startup")
+async def start_write_worker():
+    # keep the handle so shutdown can cancel it (and it can't be GC'd mid-run)
+    app.state.write_task = asyncio.create_task(_write_worker())
+
+@app.on_event("shutdown")
+async def stop_write_worker():
+    task = app.state.write_task
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    # pooled aiosqlite connections also hold non-daemon threads
+    await POOL.close()
+
 @app.get("/")
 async def root():
     return {"status":"ok", "message":"PALMS WMS AI Assistant API"}
 
+_MODELS_TTL = 60  # seconds
+_MODELS_CACHE = {"at": 0.0, "val": None}
+
 @app.get("/models")
 async def models():
+    # the installed model list changes rarely; serve from a short TTL cache
+    # instead of hitting ollama on every call
+    if time.monotonic() - _MODELS_CACHE["at"] < _MODELS_TTL and _MODELS_CACHE["val"]:
+        return _MODELS_CACHE["val"]
     # try to fetch models from ollama, fallback to defaults
     try:
-        resp = ollama.list()
+        resp = await OLLAMA.list()
         models = []
         if hasattr(resp, 'models'):
             for m in resp.models:
@@ -184,7 +369,10 @@ async def models():
                 if isinstance(m, dict) and 'model' in m: models.append(m['model'])
         if not models:
             models = [DEFAULT_MODEL, "gemma2:2b", "llama3.2:1b", "llama3.1", "mistral"]
-        return {"models": models}
+        result = {"models": models}
+        _MODELS_CACHE["at"] = time.monotonic()
+        _MODELS_CACHE["val"] = result
+        return result
     except Exception as e:
         return {"models": [DEFAULT_MODEL, "gemma2:2b", "llama3.2:1b", "llama3.1", "mistral"], "error": str(e)}
 
@@ -195,8 +383,8 @@ async def upload(files: List[UploadFile] = File(...), session_id: str = Form(...
     saved = []
     for f in files:
         try:
-            meta = save_upload(session_id, f)
-            record_file_db(session_id, meta)
+            meta = await save_upload(session_id, f)
+            await record_file_db(session_id, meta)
             saved.append({"name": meta["name"], "size": meta["size"]})
         except HTTPException as he:
             # early return error for disallowed types or sizes
@@ -211,7 +399,7 @@ async def files(session_id: str = Query(...)):
     if not session_id:
         raise HTTPException(status_code=400, detail="session_id required")
     try:
-        items = list_files_db(session_id)
+        items = await list_files_db(session_id)
         return {"files": items}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -221,14 +409,20 @@ async def files_download(session_id: str = Query(...), filename: str = Query(...
     if not session_id or not filename:
         raise HTTPException(status_code=400, detail="session_id & filename required")
     safe = safe_filename(filename)
-    con = get_db_conn(); cur = con.cursor()
-    cur.execute("SELECT filepath FROM files WHERE session_id=? AND filename=?", (session_id, safe))
-    row = cur.fetchone(); con.close()
+    async with POOL.connection() as con:
+        cur = await con.execute(SQL_FILE_PATH, (session_id, safe))
+        row = await cur.fetchone()
     if not row:
         raise HTTPException(status_code=404, detail="file not found")
     path = row["filepath"]
     if not os.path.exists(path):
         raise HTTPException(status_code=404, detail="file missing")
+    if X_ACCEL_REDIRECT_PREFIX:
+        return Response(headers={
+            "X-Accel-Redirect": f"{X_ACCEL_REDIRECT_PREFIX}/{session_id}/{safe}",
+            "Content-Disposition": f'attachment; filename="{safe}"',
+        })
+    # FileResponse uses os.sendfile(2) zero-copy when uvicorn's transport supports it
     return FileResponse(path, filename=safe)
 
 @app.delete("/delete-file")
@@ -241,9 +435,9 @@ async def delete_file(payload: dict):
     filenames = payload.get("filenames")
     try:
         if delete_all:
-            delete_files_db(session_id, None)
+            await delete_files_db(session_id, None)
         elif filenames:
-            delete_files_db(session_id, filenames)
+            await delete_files_db(session_id, filenames)
         else:
             raise HTTPException(status_code=400, detail="provide filenames or delete_all")
         return {"success": True}
@@ -254,17 +448,35 @@ async def delete_file(payload: dict):
 async def get_history(session_id: str = Query(...)):
     if not session_id:
         raise HTTPException(status_code=400, detail="session_id required")
-    return {"history": get_history_db(session_id)}
+    return {"history": await get_history_db(session_id)}
 
 @app.delete("/history")
 async def delete_history(payload: dict):
     session_id = payload.get("session_id")
     if not session_id:
         raise HTTPException(status_code=400, detail="session_id required")
-    clear_history_db(session_id)
+    await clear_history_db(session_id)
     return {"success": True}
 
 # ---------------- Chat streaming ----------------
+def _make_extractor(chunk):
+    # probe the stream's chunk shape once; the hot loop then calls one
+    # specialized accessor per token instead of an isinstance/key-test cascade
+    if isinstance(chunk, dict):
+        if isinstance(chunk.get('message'), dict):
+            return lambda c: c['message'].get('content')
+        if 'content' in chunk:
+            return lambda c: c.get('content')
+        if 'chunk' in chunk:
+            return lambda c: c.get('chunk')
+        return lambda c: None
+    if isinstance(chunk, str):
+        return lambda c: c
+    if getattr(chunk, 'message', None) is not None:
+        return lambda c: c.message.content
+    return lambda c: None
+
+
 @app.post("/chat")
 async def chat(request: Request):
     """
@@ -286,8 +498,8 @@ async def chat(request: Request):
     if not session_id or not message:
         return JSONResponse(status_code=400, content={"error":"session_id and message required"})
 
-    # record user message
-    record_message_db(session_id, 'user', message)
+    # record user message up front so it survives model failures mid-stream
+    await record_message_db(session_id, 'user', message)
 
     accept = request.headers.get("accept","")
     if "text/event-stream" in accept:
@@ -295,57 +507,50 @@ async def chat(request: Request):
             try:
                 # try streaming from ollama
                 try:
-                    stream = ollama.chat(model=model, messages=[{"role":"user","content":message}], stream=True)
+                    stream = await OLLAMA.chat(model=model, messages=[{"role":"user","content":message}], stream=True)
                 except TypeError:
                     # fallback single response
-                    resp = ollama.chat(model=model, messages=[{"role":"user","content":message}])
+                    resp = await OLLAMA.chat(model=model, messages=[{"role":"user","content":message}])
                     reply = ''
                     if isinstance(resp, dict) and 'message' in resp:
                         reply = resp['message'].get('content','')
-                    record_message_db(session_id, 'assistant', reply)
-                    yield f"data: {json.dumps({'chunk': reply})}\n\n"
-                    await asyncio.sleep(CHUNK_DELAY)
-                    yield "data: [DONE]\n\n"
+                    await record_message_db(session_id, 'assistant', reply)
+                    yield {"data": orjson.dumps({"chunk": reply}).decode()}
+                    yield {"data": "[DONE]"}
                     return
 
-                assistant_accum = ""
-                for chunk in stream:
+                # accumulate pieces in a list; repeated str += is O(n^2) for long replies
+                pieces: list[str] = []
+                extract = None
+                i = 0
+                async for chunk in stream:
                     if await request.is_disconnected():
                         break
-                    piece = None
-                    if isinstance(chunk, dict):
-                        # common shapes
-                        if 'message' in chunk and isinstance(chunk['message'], dict):
-                            piece = chunk['message'].get('content')
-                        elif 'content' in chunk:
-                            piece = chunk.get('content')
-                        elif 'chunk' in chunk:
-                            piece = chunk.get('chunk')
-                    elif isinstance(chunk, str):
-                        piece = chunk
+                    if extract is None:
+                        extract = _make_extractor(chunk)
+                    piece = extract(chunk)
                     if piece:
-                        assistant_accum += piece
-                        yield f"data: {json.dumps({'chunk': piece})}\n\n"
-                        await asyncio.sleep(CHUNK_DELAY)
-                if assistant_accum:
-                    record_message_db(session_id, 'assistant', assistant_accum)
-                yield "data: [DONE]\n\n"
+                        pieces.append(piece)
+                        yield {"data": orjson.dumps({"chunk": piece}).decode()}
+                        # uvicorn flushes each chunk eagerly; just yield control periodically
+                        if i % 32 == 0:
+                            await asyncio.sleep(0)
+                    i += 1
+                if pieces:
+                    await record_message_db(session_id, 'assistant', "".join(pieces))
+                yield {"data": "[DONE]"}
             except Exception as e:
-                yield f"data: {json.dumps({'error': str(e)})}\n\n"
-        headers = {
-            "Cache-Control": "no-cache",
-            "Connection": "keep-alive",
-            "Content-Type": "text/event-stream",
-            "Access-Control-Allow-Origin": "*"
-        }
-        return StreamingResponse(event_stream(), headers=headers, media_type="text/event-stream")
+                yield {"data": orjson.dumps({"error": str(e)}).decode()}
+        # EventSourceResponse handles SSE framing, no-cache/no-buffering headers
+        # and keep-alive pings (prevents proxy timeouts on long generations)
+        return EventSourceResponse(event_stream(), ping=15)
     else:
         # non-streaming fallback
-        resp = ollama.chat(model=model, messages=[{"role":"user","content":message}])
+        resp = await OLLAMA.chat(model=model, messages=[{"role":"user","content":message}])
         reply = ''
         if isinstance(resp, dict) and 'message' in resp:
             reply = resp['message'].get('content','')
-        record_message_db(session_id, 'assistant', reply)
+        await record_message_db(session_id, 'assistant', reply)
         return {"reply": reply}
 
 if __name__ == "__main__":